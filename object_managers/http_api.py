@@ -0,0 +1,350 @@
+import errno
+import hashlib
+import httplib
+import json
+import logging
+import socket
+import threading
+import urllib
+import urlparse
+
+from .base import ObjectManager
+
+
+# Seconds to wait on the API before giving up, so a hanging API doesn't
+# block the paginator forever.
+DEFAULT_TIMEOUT = 30
+
+
+class ApiError(Exception):
+    pass
+
+
+def _is_stale_connection_error(error):
+    """
+        Returns True if the error is the kind of error a request on a
+        keep-alive connection the server has closed in the meantime raises.
+        Timeouts aren't, retrying those would just wait for the API again.
+    """
+    if isinstance(error, (httplib.BadStatusLine, httplib.IncompleteRead)):
+        return True
+    if isinstance(error, socket.timeout):
+        return False
+    return isinstance(error, socket.error) and error.errno in (errno.EPIPE, errno.ECONNRESET)
+
+
+class HTTPConnectionPool(object):
+    """
+        A very small pool of keep-alive connections, keyed by scheme, host and
+        port. Idle connections are handed out again for the next request to the
+        same host instead of opening (and TLS handshaking) a new socket for
+        every page.
+    """
+    def __init__(self, max_idle=4, timeout=DEFAULT_TIMEOUT):
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new_connection(self, scheme, host, port):
+        if scheme == "https":
+            return httplib.HTTPSConnection(host, port, timeout=self.timeout)
+        return httplib.HTTPConnection(host, port, timeout=self.timeout)
+
+    def acquire(self, scheme, host, port):
+        """
+            Returns a tuple of (connection, reused). reused is True if the
+            connection has been used before and may have been closed by the
+            server in the meantime.
+        """
+        with self._lock:
+            idle = self._idle.get((scheme, host, port))
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(scheme, host, port), False
+
+    def release(self, scheme, host, port, connection):
+        with self._lock:
+            idle = self._idle.setdefault((scheme, host, port), [])
+            if len(idle) < self.max_idle:
+                idle.append(connection)
+                return
+        connection.close()
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def request(self, method, url, headers=None, timeout=None):
+        """
+            Does the request using a pooled connection and returns a tuple of
+            (status, body). The body is always read completely, so the
+            connection can be reused for the next request.
+
+            timeout overrides the pool's timeout for this request.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        parsed = urlparse.urlsplit(url)
+        scheme, host, port = parsed.scheme, parsed.hostname, parsed.port
+        path = parsed.path or "/"
+        if parsed.query:
+            path = "%s?%s" % (path, parsed.query)
+
+        while True:
+            connection, reused = self.acquire(scheme, host, port)
+            connection.timeout = timeout
+            if connection.sock is not None:
+                connection.sock.settimeout(timeout)
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                if reused and _is_stale_connection_error(e):
+                    # The server most likely closed the idle connection, so we
+                    # just try again with the next one.
+                    logging.info("Retrying request on a new connection: %s" % url)
+                    continue
+                raise
+
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(scheme, host, port, connection)
+            return response.status, body
+
+
+default_pool = HTTPConnectionPool()
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+
+class TokenApiManager(ObjectManager):
+    """
+        An object manager for HTTP/JSON APIs which page through their results
+        using next-page tokens. The tokens are used as cursors, so they get
+        cached by the paginator like the datastore ones.
+
+        The API is expected to return a JSON object containing the objects of
+        the page under items_key and the token for the following page under
+        next_token_key, e.g.:
+
+            {"items": [...], "next_page_token": "abc"}
+
+        If prefetch is True, the page following the latest token is fetched in
+        a background thread right after a query. It gets used for the next
+        query starting at that token. The readahead check doesn't wait for it,
+        it only uses the page if it has already arrived. As the prefetched page
+        only lives on this manager, it's only worth it if the same manager is
+        queried for more than one page.
+
+        timeout overrides the timeout of the connection pool for the requests
+        of this manager.
+    """
+    supports_cursors = True
+
+    OPTIONS = (
+        'params', 'headers', 'token_param', 'size_param', 'items_key',
+        'next_token_key', 'prefetch', 'pool', 'timeout'
+    )
+
+    def __init__(self, url, params=None, headers=None, token_param='page_token',
+                 size_param='page_size', items_key='items',
+                 next_token_key='next_page_token', prefetch=False, pool=None,
+                 timeout=None):
+        self.url = url
+        self.params = params or {}
+        self.headers = headers or {}
+        self.token_param = token_param
+        self.size_param = size_param
+        self.items_key = items_key
+        self.next_token_key = next_token_key
+        self.prefetch = prefetch
+        self.pool = pool or default_pool
+        self.timeout = timeout
+        self._starting_token = None
+        self._latest_token = None
+        self._prefetched = None
+
+    @property
+    def cache_key(self):
+        """
+            Returns a key that can be used to cache this particular object manager.
+            I.e. a unique string for the given url, parameters and headers.
+
+            The headers are hashed, so credentials like an Authorization
+            header don't end up in the cache in plain text.
+        """
+        return " ".join([
+            str(self.url),
+            str(sorted(self.params.items())),
+            hashlib.sha1(repr(sorted(self.headers.items()))).hexdigest(),
+            str(self.token_param),
+            str(self.size_param),
+            str(self.items_key),
+            str(self.next_token_key)
+        ]).replace(" ", "_")
+
+    def starting_cursor(self, cursor):
+        """
+            Let's you set the starting token. Should be called before actually
+            calling __getitem__()
+        """
+        self._starting_token = cursor
+        self._latest_token = None
+
+    @property
+    def next_cursor(self):
+        """
+            Returns the token of the page following the latest query.
+        """
+        return self._latest_token
+
+    def _build_url(self, token, size):
+        params = dict(self.params)
+        if token:
+            params[self.token_param] = token
+        if size is not None:
+            params[self.size_param] = size
+
+        if not params:
+            return self.url
+        # urlencode() can't handle non-ASCII unicode, so encode it first.
+        params = [
+            (_encode(key), _encode(value)) for key, value in sorted(params.items())
+        ]
+        separator = "&" if "?" in self.url else "?"
+        return self.url + separator + urllib.urlencode(params)
+
+    def _request_page(self, token, size):
+        """
+            Requests a single page from the API and returns a tuple of
+            (items, next_token).
+        """
+        headers = {"Accept": "application/json"}
+        headers.update(self.headers)
+
+        url = self._build_url(token, size)
+        status, body = self.pool.request("GET", url, headers=headers, timeout=self.timeout)
+        if status != 200:
+            raise ApiError("%s returned status %s" % (url, status))
+
+        try:
+            data = json.loads(body)
+        except ValueError:
+            raise ApiError("%s didn't return valid JSON" % url)
+        if not isinstance(data, dict):
+            raise ApiError("%s didn't return a JSON object" % url)
+
+        return list(data.get(self.items_key) or []), data.get(self.next_token_key) or None
+
+    def _start_prefetch(self, token, size):
+        result = {}
+
+        def fetch():
+            try:
+                result["page"] = self._request_page(token, size)
+            except Exception:
+                logging.exception("Prefetching the page for token %s failed" % token)
+
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        self._prefetched = (token, size, thread, result)
+
+    def _take_prefetched(self, token, size=None, wait=True):
+        """
+            Returns the prefetched page for the given token (and size) or None
+            if it wasn't prefetched or the prefetch failed. With wait=False
+            None is also returned if the prefetch hasn't finished yet.
+
+            If the prefetch doesn't finish within the timeout, socket.timeout
+            is raised instead of requesting the page again, so waiting on a
+            hanging API takes one timeout and not one for the prefetch plus one
+            for the request.
+        """
+        if self._prefetched is None:
+            return None
+
+        prefetched_token, prefetched_size, thread, result = self._prefetched
+        if prefetched_token != token or (size is not None and prefetched_size != size):
+            return None
+
+        if not wait:
+            return None if thread.is_alive() else result.get("page")
+
+        timeout = self.timeout if self.timeout is not None else self.pool.timeout
+        thread.join(timeout)
+        if thread.is_alive():
+            # Don't wait on the same thread again.
+            self._prefetched = None
+            raise socket.timeout("Prefetching the page for token %s timed out" % token)
+        return result.get("page")
+
+    def _fetch_page(self, token, size):
+        page = self._take_prefetched(token, size)
+        self._prefetched = None
+        if page is not None:
+            return page
+        return self._request_page(token, size)
+
+    def __getitem__(self, value):
+        """
+            Does the query, following the tokens until enough objects have been
+            retrieved, saves the next token to self and returns the objects in
+            form of a list.
+        """
+        if isinstance(value, slice):
+            start, stop = value.start or 0, value.stop
+        else:
+            start, stop = value, value + 1
+
+        token = self._starting_token
+        self._starting_token = None
+        self._latest_token = None
+
+        objects = []
+        while True:
+            size = None if stop is None else stop - len(objects)
+            items, token = self._fetch_page(token, size)
+            objects.extend(items)
+            if not token or (stop is not None and len(objects) >= stop):
+                break
+
+        if stop is not None and len(objects) > stop:
+            # The API ignored the requested page size, so the token doesn't
+            # point to the end of the requested objects.
+            token = None
+
+        self._latest_token = token
+        if token and self.prefetch and stop is not None:
+            self._start_prefetch(token, stop - start)
+
+        return objects[value]
+
+    def contains_more_objects(self, next_cursor):
+        """
+            Returns a boolean telling if there are more objects available after
+            the given token or if there aren't.
+        """
+        if not next_cursor:
+            return False
+
+        # Waiting for the whole prefetched batch would take longer than
+        # requesting a single object.
+        page = self._take_prefetched(next_cursor, wait=False)
+        if page is not None:
+            return bool(page[0])
+
+        items, token = self._request_page(next_cursor, 1)
+        return bool(items)
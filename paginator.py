@@ -250,3 +250,18 @@ class GaeNdbPaginator(UnifiedPaginator):
         from object_managers.ndb_api import GaeNdbModelManager
         object_list = GaeNdbModelManager(query)
         super(GaeNdbPaginator, self).__init__(object_list, *args, **kwargs)
+
+
+class TokenApiPaginator(UnifiedPaginator):
+    """
+        Paginator for HTTP/JSON APIs paging through their results with next-page
+        tokens. Options of the TokenApiManager (params, headers, etc.) can be
+        passed in as keyword arguments.
+    """
+    def __init__(self, url, *args, **kwargs):
+        from object_managers.http_api import TokenApiManager
+        manager_kwargs = dict(
+            (option, kwargs.pop(option)) for option in TokenApiManager.OPTIONS if option in kwargs
+        )
+        object_list = TokenApiManager(url, **manager_kwargs)
+        super(TokenApiPaginator, self).__init__(object_list, *args, **kwargs)
@@ -1,5 +1,15 @@
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import sys
+import threading
+import time
+import urlparse
+
 from google.appengine.ext import ndb
 
+from django.core.cache import cache
 from django.db import models
 from django.test import TestCase
 
@@ -8,8 +18,15 @@ import mock
 from potatopage.paginator import (
     DjangoNonrelPaginator,
     GaeNdbPaginator,
+    TokenApiPaginator,
     EmptyPage
 )
+from potatopage.object_managers.http_api import (
+    ApiError,
+    HTTPConnectionPool,
+    TokenApiManager,
+    default_pool
+)
 
 
 class DjangoNonrelPaginationModel(models.Model):
@@ -155,3 +172,252 @@ class GaeNdbPaginatorTests(TestCase):
 
         self.assertEqual(2, len(page3.object_list))
         self.assertEqual(10, page3.object_list[0].field1)
+
+
+class TokenApiHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+        Stand-in for a token paginated API. Tokens are just the offsets, wrapped
+        so they don't look like numbers.
+    """
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        params = dict(urlparse.parse_qsl(urlparse.urlsplit(self.path).query))
+        start = int(params.get("page_token", "token-0").split("-")[1])
+        stop = start + int(self.server.forced_page_size or params.get("page_size", 3))
+        objects = self.server.objects
+
+        data = {"items": objects[start:stop]}
+        if stop < len(objects):
+            data["next_page_token"] = "token-%s" % stop
+
+        self.server.requests.append(params)
+        self.server.client_ports.add(self.client_address[1])
+
+        if self.server.delay and self.server.delay_token in (None, params.get("page_token")):
+            self.server.stopped.wait(self.server.delay)
+
+        if self.server.drop_connections:
+            # Close the connection without telling the client, like a server
+            # timing out idle keep-alive connections.
+            self.close_connection = 1
+
+        body = self.server.body or json.dumps(data)
+        self.send_response(self.server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TokenApiServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients give up on delayed responses in the timeout tests, so writing
+        # the response fails.
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+
+class TokenApiPaginatorTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.server = TokenApiServer(("127.0.0.1", 0), TokenApiHandler)
+        self.server.objects = range(12)
+        self.server.requests = []
+        self.server.client_ports = set()
+        self.server.delay = 0
+        self.server.delay_token = None
+        self.server.stopped = threading.Event()
+        self.server.status = 200
+        self.server.forced_page_size = None
+        self.server.drop_connections = False
+        self.server.body = None
+        self.url = "http://127.0.0.1:%s/objects" % self.server.server_port
+
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        default_pool.clear()
+        # Let delayed handlers finish instead of writing to closed sockets later
+        self.server.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_basic_usage(self):
+        paginator = TokenApiPaginator(self.url, 5)
+
+        page1 = paginator.page(1)
+        self.assertEqual([0, 1, 2, 3, 4], page1.object_list)
+        self.assertTrue(page1.has_next())
+        self.assertFalse(page1.has_previous())
+        self.assertEqual([1, 2], page1.available_pages())
+
+        page2 = paginator.page(2)
+        self.assertEqual([5, 6, 7, 8, 9], page2.object_list)
+        self.assertTrue(page2.has_next())
+        self.assertTrue(page2.has_previous())
+        self.assertEqual([1, 2, 3], page2.available_pages())
+
+        page3 = paginator.page(3)
+        self.assertEqual([10, 11], page3.object_list)
+        self.assertFalse(page3.has_next())
+        self.assertTrue(page3.has_previous())
+        self.assertEqual([2, 3], page3.available_pages())
+
+        self.assertRaises(EmptyPage, paginator.page, 4)
+
+    def test_no_prefetch_by_default(self):
+        paginator = TokenApiPaginator(self.url, 5)
+
+        paginator.page(1)
+        # Only the batch itself and the single object readahead
+        self.assertEqual([
+            {"page_size": "5"},
+            {"page_size": "1", "page_token": "token-5"},
+        ], self.server.requests)
+
+    def test_cursor_caching(self):
+        # The API doesn't return a token after the last page, so make sure
+        # there are objects after the second batch.
+        self.server.objects = range(22)
+        paginator = TokenApiPaginator(self.url, 5, batch_size=2)
+
+        paginator.page(3)
+
+        self.assertFalse(paginator.has_cursor_for_page(2))
+        self.assertFalse(paginator.has_cursor_for_page(3))
+        self.assertTrue(paginator.has_cursor_for_page(5))
+
+        paginator.page(1)
+        self.assertFalse(paginator.has_cursor_for_page(2))
+        self.assertTrue(paginator.has_cursor_for_page(3))
+        self.assertTrue(paginator.has_cursor_for_page(5))
+
+        with mock.patch("potatopage.paginator.TokenApiPaginator._process_batch_hook") as mock_obj:
+            #Should now use the cached token
+            page3 = paginator.page(3)
+            self.assertEqual("token-10", mock_obj.call_args[0][2])
+
+        self.assertEqual([10, 11, 12, 13, 14], page3.object_list)
+
+    def test_prefetch(self):
+        # Without readahead nothing else requests the page for the next token
+        paginator = TokenApiPaginator(self.url, 5, readahead=False, prefetch=True)
+
+        paginator.page(1)
+        page2 = paginator.page(2)
+        self.assertEqual([5, 6, 7, 8, 9], page2.object_list)
+
+        page3 = paginator.page(3)
+        self.assertEqual([10, 11], page3.object_list)
+
+        # Pages 2 and 3 came from the prefetches, there is no token after page 3
+        self.assertEqual([
+            {"page_size": "5"},
+            {"page_size": "5", "page_token": "token-5"},
+            {"page_size": "5", "page_token": "token-10"},
+        ], self.server.requests)
+
+    def test_connections_are_reused(self):
+        paginator = TokenApiPaginator(self.url, 5)
+        paginator.page(1)
+        paginator.page(2)
+        paginator.page(3)
+
+        self.assertEqual(1, len(self.server.client_ports))
+
+    def test_cache_key_depends_on_headers(self):
+        manager1 = TokenApiManager(self.url, headers={"Authorization": "Bearer secret1"})
+        manager2 = TokenApiManager(self.url, headers={"Authorization": "Bearer secret2"})
+
+        self.assertNotEqual(manager1.cache_key, manager2.cache_key)
+        self.assertFalse("secret1" in manager1.cache_key)
+
+    def test_timeout(self):
+        self.server.delay = 1
+        paginator = TokenApiPaginator(self.url, 5, timeout=0.1)
+
+        self.assertRaises(socket.timeout, paginator.page, 1)
+
+    def test_timeout_with_pooled_connections(self):
+        pool = HTTPConnectionPool(timeout=0.2)
+        self.addCleanup(pool.clear)
+
+        # Put a few idle keep-alive connections into the pool
+        connections = [pool.acquire("http", "127.0.0.1", self.server.server_port)[0] for i in range(3)]
+        for connection in connections:
+            connection.request("GET", "/objects")
+            connection.getresponse().read()
+            pool.release("http", "127.0.0.1", self.server.server_port, connection)
+
+        self.server.requests = []
+        self.server.delay = 1
+        manager = TokenApiManager(self.url, pool=pool)
+
+        self.assertRaises(socket.timeout, manager.__getitem__, slice(0, 5))
+        # The timeout isn't retried on the other idle connections
+        self.assertEqual(1, len(self.server.requests))
+
+    def test_prefetch_timeout(self):
+        self.server.delay = 1
+        self.server.delay_token = "token-5"
+        manager = TokenApiManager(self.url, prefetch=True, timeout=0.3)
+        manager[0:5]
+
+        started = time.time()
+        manager.starting_cursor(manager.next_cursor)
+        self.assertRaises(socket.timeout, manager.__getitem__, slice(0, 5))
+        # Only waited once for the prefetch and didn't request the page again
+        self.assertTrue(time.time() - started < 0.6)
+        self.assertEqual(2, len(self.server.requests))
+
+        # The stuck prefetch isn't waited on again
+        self.assertEqual(None, manager._prefetched)
+
+    def test_unicode_params(self):
+        manager = TokenApiManager(self.url, params={"q": u"caf\xe9"})
+
+        self.assertEqual([0, 1], manager[0:2])
+        self.assertEqual(u"caf\xe9", self.server.requests[0]["q"].decode("utf-8"))
+
+    def test_error_status(self):
+        self.server.status = 500
+        paginator = TokenApiPaginator(self.url, 5)
+
+        self.assertRaises(ApiError, paginator.page, 1)
+
+    def test_invalid_json(self):
+        paginator = TokenApiPaginator(self.url, 5)
+
+        self.server.body = "<html>Bad Gateway</html>"
+        self.assertRaises(ApiError, paginator.page, 1)
+
+        self.server.body = "[0, 1, 2]"
+        self.assertRaises(ApiError, paginator.page, 1)
+
+    def test_retry_on_closed_connection(self):
+        self.server.drop_connections = True
+        manager = TokenApiManager(self.url)
+
+        self.assertEqual([0, 1, 2, 3, 4], manager[0:5])
+        # The closed connection went back to the pool
+        self.assertEqual(1, sum(len(idle) for idle in default_pool._idle.values()))
+
+        manager.starting_cursor(manager.next_cursor)
+        self.assertEqual([5, 6, 7, 8, 9], manager[:5])
+        self.assertEqual(2, len(self.server.client_ports))
+
+    def test_page_size_ignored(self):
+        self.server.forced_page_size = 8
+        manager = TokenApiManager(self.url)
+
+        self.assertEqual([0, 1, 2, 3, 4], manager[0:5])
+        # The token points after the 8th object, so it can't be used as cursor
+        self.assertEqual(None, manager.next_cursor)